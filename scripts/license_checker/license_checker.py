@@ -1,10 +1,20 @@
+import io
 import os
 import re
 import enum
 import json
 import codecs
+import hashlib
+import concurrent.futures
+from collections import defaultdict
+from typing import Iterable, Optional
 
 CONFIG_PATH = 'config.json'
+DATE_PATTERN = re.compile(r'\d\d\d\d')
+DATE_RANGE_PATTERN = re.compile(r'(\d\d\d\d)-(\d\d\d\d)')
+HEADER_SIZE = 4096
+"""Bump when the checking logic changes, so results of an older checker are not reused."""
+CACHE_VERSION = 1
 
 class ErrorType(enum.Enum):
 	INVALID_LICENSE = 1
@@ -78,13 +88,15 @@ with open(CONFIG_PATH, 'r') as j:
 	_json: dict = json.load(j)
 	BASE_PATH: str = _json.get('basePath') or '../../../'
 	REPORT_FOLDER: str = _json.get('reportFolder') or 'build_tools/scripts/license_checker/reports'
+	"""An empty or null cachePath turns the cache off."""
+	CACHE_PATH: Optional[str] = _json.get('cachePath', 'build_tools/scripts/license_checker/.license_checker_cache.json') or None
 	if (_json.get('fix')):
 		try:
-			FIX: list[ErrorType] = list(map(lambda x: FIX_TYPES[x], _json.get('fix')))
+			FIX: Optional[frozenset[ErrorType]] = frozenset(FIX_TYPES[x] for x in _json.get('fix'))
 		except KeyError:
 			raise Exception(f'KeyError. "fix" cannot process value. It must be an array of strings. Check {CONFIG_PATH}. Possible array values: "OUTDATED", "NO_LICENSE", "INVALID_LICENSE", "LEN_MISMATCH"')
 	else:
-		FIX = False
+		FIX = None
 	PRINT_CHECKING: bool = _json.get('printChecking')
 	PRINT_REPORTS: bool = _json.get('printReports')
 	CONFIGS: list[Config] = []
@@ -94,70 +106,162 @@ with open(CONFIG_PATH, 'r') as j:
 os.chdir(BASE_PATH)
 
 class Error(object):
+	__slots__ = ('_errorType',)
+	_errorMessages = {
+		ErrorType.INVALID_LICENSE: 'Detected license is invalid',
+		ErrorType.NO_LICENSE: 'The license was not found',
+		ErrorType.OUTDATED: 'Detected license is outdated',
+		ErrorType.LEN_MISMATCH: 'Detected license length does not match pattern'
+	}
 	def __init__(self, errorType: ErrorType) -> None:
 		self._errorType = errorType
-		self._errorMessages = {
-			ErrorType.INVALID_LICENSE: 'Detected license is invalid',
-			ErrorType.NO_LICENSE: 'The license was not found',
-			ErrorType.OUTDATED: 'Detected license is outdated',
-			ErrorType.LEN_MISMATCH: 'Detected license length does not match pattern'
-		}
 	def getErrorType(self) -> ErrorType:
 		return self._errorType
 	def getErrorMessage(self) -> str:
 		return self._errorMessages.get(self._errorType)
 		
 class Report(object):
-	def __init__(self, pathToFile: str, error: Error, message:str = '') -> None:
+	"""
+	Check result of a file.
+	The message is a format string, it is filled with args only when the report is printed.
+	"""
+	__slots__ = ('_pathToFile', '_error', '_message', '_args')
+	def __init__(self, pathToFile: str, error: Error, message:str = '', args: tuple = ()) -> None:
 		self._pathToFile = pathToFile
 		self._error = error
 		self._message = message
+		self._args = args
 	def getPathToFile(self) -> str:
 		return self._pathToFile
 	def getError(self) -> Error:
 		return self._error
-	def getMessage(self) -> str:
+	def getMessageFormat(self) -> str:
 		return self._message
+	def getMessageArgs(self) -> tuple:
+		return self._args
+	def getMessage(self) -> str:
+		return self._message.format(*self._args)
 	def report(self) -> str:
 		return f'{self.getPathToFile()}: {self.getError().getErrorMessage()}. {self.getMessage()}.'
 
+class Cache(object):
+	"""
+	Results of previous checks.
+	Entries are grouped by license template and are valid while the file size and modification time are unchanged.
+	Only entries of files checked during the current run are saved, cache hits included.
+	Without a path nothing is read or saved.
+	"""
+	def __init__(self, path: Optional[str]) -> None:
+		self._path = path
+		self._entries: dict[str, dict[str, list]] = {}
+		self._newEntries: dict[str, dict[str, list]] = {}
+		if not path:
+			return
+		try:
+			with open(path, 'r', encoding="utf8") as file:
+				self._entries = json.load(file)
+		except (OSError, ValueError):
+			pass
+	def get(self, licenseKey: str, pathToFile: str, stat: os.stat_result) -> tuple[bool, Optional[Report]]:
+		"""Returns whether the file is cached and its cached report. A hit is kept for the next save."""
+		if not self._path:
+			return False, None
+		entry = self._entries.get(licenseKey, {}).get(pathToFile)
+		if not entry or len(entry) != 5 or entry[0] != stat.st_mtime_ns or entry[1] != stat.st_size:
+			return False, None
+		self._newEntries.setdefault(licenseKey, {})[pathToFile] = entry
+		if entry[2] is None:
+			return True, None
+		return True, Report(pathToFile=pathToFile, error=Error(errorType=ErrorType[entry[2]]), message=entry[3], args=tuple(entry[4]))
+	def set(self, licenseKey: str, pathToFile: str, stat: os.stat_result, report: Optional[Report]) -> None:
+		if not self._path:
+			return
+		errorType = report.getError().getErrorType().name if report else None
+		message = report.getMessageFormat() if report else ''
+		args = list(report.getMessageArgs()) if report else []
+		self._newEntries.setdefault(licenseKey, {})[pathToFile] = [stat.st_mtime_ns, stat.st_size, errorType, message, args]
+	def save(self) -> None:
+		if not self._path:
+			return
+		folder = os.path.dirname(self._path)
+		if folder and not os.path.exists(folder):
+			os.makedirs(folder)
+		with open(self._path, 'w', encoding="utf8") as file:
+			json.dump(self._newEntries, file)
+
 class Checker(object):
 	def __init__(self, config: Config) -> None:
 		self._config = config
 		self._reports: list[Report] = []
+		self._license = config.getLicense()
+		licenseText = ''.join(self._license)
+		self._licenseKey = f'{CACHE_VERSION}-{hashlib.sha1(licenseText.encode("utf8")).hexdigest()}'
+		"""Leave room for leading blank lines and a license longer than expected."""
+		self._headerSize = max(HEADER_SIZE, 2 * len(licenseText.encode('utf8')))
+		"""The whole license with any years in place of the date, to tell an outdated license with one match."""
+		self._licensePattern: Optional[re.Pattern] = None
+		self._licenseLastYear = 0
+		date = DATE_RANGE_PATTERN.search(licenseText)
+		if date:
+			self._licensePattern = re.compile(re.escape(licenseText[:date.start()]) + DATE_RANGE_PATTERN.pattern + re.escape(licenseText[date.end():]))
+			self._licenseLastYear = int(date.group(2))
+		"""Trim to catch invalid license without leading spaces"""
+		self._startMultiComm = config.getStartMultiComm().lstrip()
+		self._endMultiComm = config.getEndMultiComm().strip()
 	def getReports(self):
 		return self._reports
-	def _checkLine(self, line: str, prefix: str) -> bool:
-		"""Checks if a line has a prefix."""
-		"""Trim to catch invalid license without leading spaces"""
-		prefix = prefix.lstrip()
-		if (re.search(re.escape(prefix), line)):
-			return True
-		else:
-			return False
-	def findLicense(self, lines: list[str]) -> list[str]:
+	def getLicense(self) -> list[str]:
+		return self._license
+	def findLicense(self, lines: Iterable[str]) -> list[str]:
 		"""Looks for consecutive comments in a list of strings."""
+		return self._findLicense(lines=lines)[0]
+	def _findLicense(self, lines: Iterable[str]) -> tuple[list[str], bool]:
+		"""
+		Looks for consecutive comments in a list of strings.
+		Stops consuming lines as soon as the comment ends, so a file object can be passed to read only its header.
+		Also returns whether the search ended by itself, False means the lines ran out before the comment was over.
+		"""
 		result = []
 		isStarted = False
 		for line in lines:
 			if line == '\n': continue
-			if (self._checkLine(line=line, prefix=self._config.getStartMultiComm())):
+			if (line.lstrip().startswith(self._startMultiComm)):
 				result.append(line)
 				isStarted = True
-			elif(self._checkLine(line=line, prefix=self._config.getEndMultiComm())):
+			elif (line.rstrip().endswith(self._endMultiComm)):
+				"""Trailing whitespace after the end comment and a missing newline at the end of the file are accepted."""
 				result.append(line)
-				break
+				return result, True
 			elif (isStarted):
 				result.append(line)
 			else:
-				break
-		return result
-	def _checkLicense(self, test: list[str], pathToFile: str) -> Report:
-		license = self._config.getLicense()
+				return result, True
+		return result, False
+	def _checkDate(self, pathToFile: str, testLastYear: int, licenseLastYear: int) -> Report:
+		if (testLastYear < licenseLastYear):
+			return Report(pathToFile=pathToFile,
+				error=Error(errorType=ErrorType.OUTDATED),
+				message='Found date {}, expected {}',
+				args=(testLastYear, licenseLastYear))
+		else:
+			return Report(pathToFile=pathToFile,
+				error=Error(errorType=ErrorType.INVALID_LICENSE),
+				message="Found something similar to the date: {}, but it's not correct. Expected: {}",
+				args=(testLastYear, licenseLastYear))
+	def _checkLicense(self, test: list[str], pathToFile: str) -> Optional[Report]:
+		license = self._license
 		if len(license) != len(test):
 			return Report(pathToFile=pathToFile,
 				error=Error(errorType=ErrorType.LEN_MISMATCH),
-				message=f'Found {len(test)} lines, expected {len(license)}')
+				message='Found {} lines, expected {}',
+				args=(len(test), len(license)))
+		"""Most licenses are valid, compare the whole lists before looking for wrong lines."""
+		if test == license:
+			return None
+		if self._licensePattern:
+			date = self._licensePattern.fullmatch(''.join(test))
+			if date:
+				return self._checkDate(pathToFile=pathToFile, testLastYear=int(date.group(2)), licenseLastYear=self._licenseLastYear)
 		invalidLinesCount = 0
 		lastWrongLine = 0
 		for i in range(len(license)):
@@ -165,83 +269,126 @@ class Checker(object):
 				invalidLinesCount += 1
 				lastWrongLine = i
 		if (invalidLinesCount == 1):
-			r = r'\d\d\d\d'
-			testDate = re.findall(r, test[lastWrongLine])
-			licenseDate = re.findall(r, license[lastWrongLine])
+			testDate = DATE_PATTERN.findall(test[lastWrongLine])
+			licenseDate = DATE_PATTERN.findall(license[lastWrongLine])
 
 			if not (testDate and licenseDate):
 				return Report(pathToFile=pathToFile,
 				error=Error(errorType=ErrorType.INVALID_LICENSE),
-				message=f'Something wrong...')
+				message='Something wrong...')
 
-			testLastYear = int(testDate[-1])
-			licenseLastYear = int(licenseDate[-1])
-			if (testLastYear < licenseLastYear):
-				return Report(pathToFile=pathToFile,
-					error=Error(errorType=ErrorType.OUTDATED),
-					message=f'Found date {testLastYear}, expected {licenseLastYear}')
-			else:
-				return Report(pathToFile=pathToFile,
-					error=Error(errorType=ErrorType.INVALID_LICENSE),
-					message=f"Found something similar to the date: {testLastYear}, but it's not correct. Expected: {licenseLastYear}")
+			return self._checkDate(pathToFile=pathToFile, testLastYear=int(testDate[-1]), licenseLastYear=int(licenseDate[-1]))
 		elif (invalidLinesCount > 0):
 			return Report(pathToFile=pathToFile,
 				error=Error(errorType=ErrorType.INVALID_LICENSE),
-				message=f'Found {invalidLinesCount} wrong lines out of {len(license)}')
-	def checkFile(self, pathToFile: str) -> None:
-		"""Checks a file for a valid license."""
-		with open(pathToFile, 'r', encoding="utf-8-sig") as file:
-			test = self.findLicense(lines=file.readlines())
-			if test:
-				result = self._checkLicense(test=test, pathToFile=pathToFile)
-				if result:
-					self._reports.append(result)
-			else:
-				self._reports.append(Report(pathToFile=pathToFile, error=Error(errorType=ErrorType.NO_LICENSE)))
-		return
+				message='Found {} wrong lines out of {}',
+				args=(invalidLinesCount, len(license)))
+	def checkFile(self, pathToFile: str) -> Optional[Report]:
+		"""Checks a file for a valid license.
+		Does not touch the checker state, so files can be checked concurrently."""
+		stat = os.stat(pathToFile)
+		isCached, report = CACHE.get(licenseKey=self._licenseKey, pathToFile=pathToFile, stat=stat)
+		if isCached:
+			return report
+		"""Plain descriptor calls, a file object is not needed for a single read."""
+		fd = os.open(pathToFile, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+		try:
+			header = os.read(fd, self._headerSize)
+		finally:
+			os.close(fd)
+		isTruncated = stat.st_size > len(header)
+		isFinished = True
+		if isTruncated and header.rfind(b'\n') == -1:
+			"""The first line is longer than the header (e.g. minified code), it can only be a license if it opens a comment."""
+			firstLine = header.decode('utf-8-sig', errors='ignore')
+			if firstLine.lstrip().startswith(self._startMultiComm.rstrip()):
+				isFinished = False
+			test = []
+		else:
+			if isTruncated:
+				"""Drop the incomplete last line, it can also end in the middle of a character."""
+				header = header[:header.rfind(b'\n') + 1]
+			test, isFinished = self._findLicense(lines=io.StringIO(header.decode('utf-8-sig'), newline=None))
+		if isTruncated and not isFinished:
+			"""The comment did not end within the header, check the whole file."""
+			with open(pathToFile, 'r', encoding="utf-8-sig") as file:
+				test = self.findLicense(lines=file)
+		if test:
+			report = self._checkLicense(test=test, pathToFile=pathToFile)
+		else:
+			report = Report(pathToFile=pathToFile, error=Error(errorType=ErrorType.NO_LICENSE))
+		CACHE.set(licenseKey=self._licenseKey, pathToFile=pathToFile, stat=stat, report=report)
+		return report
+	def addReport(self, report: Report) -> None:
+		self._reports.append(report)
 
 class Walker(object):
 	def __init__(self, config: Config) -> None:
 		self._config = config
 		self._checker = Checker(config=self._config)
+		self._ignoreListDir = [os.path.normpath(i) for i in config.getIgnoreListDir()]
+		self._fileExtensions = tuple(config.getFileExtensions())
+		self._allowListFile = frozenset(os.path.normpath(i) for i in config.getAllowListFile())
+		self._ignoreListFile = frozenset(os.path.normpath(i) for i in config.getIgnoreListFile())
+		"""Folders leading to allowed files must be walked even if they are ignored."""
+		self._allowListDir = set()
+		for i in self._allowListFile:
+			i = os.path.dirname(i)
+			while i and i not in self._allowListDir:
+				self._allowListDir.add(i)
+				i = os.path.dirname(i)
 	def getChecker(self):
 		return self._checker
 	def getConfig(self):
 		return self._config
+	def _isIgnoredDir(self, address: str) -> bool:
+		for i in self._config.getIgnoreListDirName():
+			if (i in address):
+				return True
+		for i in self._ignoreListDir:
+			if (i in address):
+				return True
+		return False
+	def _isWalkedDir(self, address: str) -> bool:
+		return address in self._allowListDir or not self._isIgnoredDir(address)
 	def _getFiles(self) -> list[str]:
 		result = []
-		for address, dirs, files in os.walk(self._config.getDir()):
-			for i in files:
-				if (os.path.join(address, i) in list(map(lambda x: os.path.normpath(x), self._config.getAllowListFile()))):
-					filename, file_extension = os.path.splitext(i)
-					if file_extension in self._config.getFileExtensions():
-						result.append(os.path.join(address, i))
+		"""Walk from a normalized path, so the joined paths can be compared with the normalized lists as is."""
+		root = os.path.normpath(self._config.getDir())
+		isRootIgnored = self._isIgnoredDir(root)
+		for address, dirs, files in os.walk(root, topdown=True):
+			"""Prune ignored subtrees, every subfolder of an ignored folder is ignored too."""
+			dirs[:] = [d for d in dirs if self._isWalkedDir(os.path.join(address, d))]
+			"""A subfolder that survived pruning is ignored only if it leads to allowed files."""
+			if (address == root):
+				isIgnored = isRootIgnored
 			else:
-				for i in self._config.getIgnoreListDirName():
-					if(re.search(re.escape(i), address)):
-						break
-				else:
-					for i in self._config.getIgnoreListDir():
-						if(re.search(re.escape(os.path.normpath(i)), address)):
-							break
-					else:
-						for i in files:
-							if not (os.path.join(address, i) in list(map(lambda x: os.path.normpath(x), self._config.getIgnoreListFile()))):
-								filename, file_extension = os.path.splitext(i)
-								if file_extension in self._config.getFileExtensions():
-									result.append(os.path.join(address, i))
+				isIgnored = address in self._allowListDir and self._isIgnoredDir(address)
+			if (isIgnored and address not in self._allowListDir):
+				continue
+			for i in files:
+				if not i.endswith(self._fileExtensions):
+					continue
+				path = os.path.join(address, i)
+				if (self._allowListFile and path in self._allowListFile):
+					result.append(path)
+				elif (not isIgnored and not (self._ignoreListFile and path in self._ignoreListFile)):
+					result.append(path)
 		return result
+	def _checkFile(self, pathToFile: str) -> Optional[Report]:
+		if (PRINT_CHECKING):
+			print(f'Checking {pathToFile}...')
+		try:
+			return self._checker.checkFile(pathToFile)
+		except Exception as e:
+			print(pathToFile)
+			print(e)
 	def checkFiles(self) -> list[Report]:
 		files = self._getFiles()
-		for file in files:
-			if (PRINT_CHECKING):
-				print(f'Checking {file}...')
-			# self._checker.checkFile(file)
-			try:
-				self._checker.checkFile(file)
-			except Exception as e:
-				print(file)	
-				print(e)			
+		with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+			for report in executor.map(self._checkFile, files):
+				if report:
+					self._checker.addReport(report)
 		return self._checker.getReports()
 
 class Fixer(object):
@@ -252,40 +399,58 @@ class Fixer(object):
 	def fix(self):
 		count = 0
 		for report in self._checker.getReports():
-			if ((not FIX and report.getError().getErrorType() == ErrorType.NO_LICENSE) or (report.getError().getErrorType() == ErrorType.NO_LICENSE and report.getError().getErrorType() in FIX)):
-				self._addLicense(report.getPathToFile())
-				count += 1
-			elif ((not FIX and report.getError().getErrorType() != ErrorType.NO_LICENSE) or (report.getError().getErrorType() != ErrorType.NO_LICENSE and report.getError().getErrorType() in FIX)):
-				self._fixLicense(report.getPathToFile())
-				count += 1
+			errorType = report.getError().getErrorType()
+			"""Without selected categories every report is fixed."""
+			if (FIX is not None and errorType not in FIX):
+				continue
+			"""Only the header was decoded while checking, the rest of the file can still fail to decode."""
+			try:
+				if (errorType == ErrorType.NO_LICENSE):
+					self._addLicense(report.getPathToFile())
+				else:
+					self._fixLicense(report.getPathToFile())
+			except Exception as e:
+				print(report.getPathToFile())
+				print(e)
+				continue
+			count += 1
 		return count
 	def _addLicense(self, pathToFile: str):
-		buffer = []
+		buffer = ''
 		with open(pathToFile, 'r', encoding="utf8") as file:
-			buffer = file.readlines()
+			buffer = file.read()
 		with open(pathToFile, 'w', encoding="utf8") as file:
-			license = self._config.getLicense()
-			file.writelines(license)
-			file.write('\n')
-			file.writelines(buffer)
+			license = self._checker.getLicense()
+			file.write(''.join(license) + '\n' + buffer)
 		return
 	def _fixLicense(self, pathToFile: str):
-		buffer = []
-		writeEncoding = "utf8"
-		with open(pathToFile, 'r', encoding="utf8") as file:
+		with open(pathToFile, 'r+', encoding="utf8") as file:
 			buffer = file.readlines()
+			bom = ''
 			if buffer and buffer[0].startswith(codecs.decode(codecs.BOM_UTF8)):
-				writeEncoding = "utf-8-sig"
+				"""Keep the BOM at the beginning of the file, not in front of the old license."""
+				bom = buffer[0][0]
+				buffer[0] = buffer[0][1:]
 			oldLicense = self._checker.findLicense(buffer)
-			for i in oldLicense:
-				buffer.remove(i)
-		with open(pathToFile, 'w', encoding=writeEncoding) as file:
-			license = self._config.getLicense()
-			file.writelines(license)
-			file.writelines(buffer)
+			"""findLicense skips blank lines, so the old license ends after its last non-blank line."""
+			start = 0
+			while start < len(buffer) and buffer[start] == '\n':
+				start += 1
+			end = start
+			count = 0
+			while count < len(oldLicense):
+				if buffer[end] != '\n':
+					count += 1
+				end += 1
+			buffer[start:end] = []
+			file.seek(0)
+			file.truncate()
+			license = self._checker.getLicense()
+			file.write(bom + ''.join(license) + ''.join(buffer))
 		return
 
 
+CACHE = Cache(path=CACHE_PATH)
 walkers: list[Walker] = []
 reports: list[Report] = []
 
@@ -301,14 +466,12 @@ def fix(walkers):
 	print(f'Fixed {count} files.')
 
 def writeReports(reports: list[Report]) -> None:
-	files: dict[str, list[Report]] = dict()
-	for i in ErrorType:
-		files[i.name] = []
+	files: defaultdict[ErrorType, list[Report]] = defaultdict(list)
 	for i in reports:
-		files[i.getError().getErrorType().name].append(i)
+		files[i.getError().getErrorType()].append(i)
 	for i in ErrorType:
 		with open(f'{REPORT_FOLDER}/{i.name}.txt', 'w', encoding="utf8") as f:
-			f.writelines(map(lambda x: "".join([x.report(), '\n']), files.get(i.name)))
+			f.write(''.join(x.report() + '\n' for x in files[i]))
 
 for config in CONFIGS:
 	walkers.append(Walker(config=config))
@@ -316,7 +479,8 @@ for config in CONFIGS:
 print('Checking files...')
 
 for walker in walkers:
-	reports = reports + walker.checkFiles()
+	reports.extend(walker.checkFiles())
+CACHE.save()
 
 if reports:
 	if not os.path.exists(REPORT_FOLDER):